@@ -3,18 +3,68 @@
 # Connects to Wordly WSS API and prints finalized captions to the console.
 # Now also logs all raw incoming JSON data for inspection.
 
+import argparse
 import asyncio
 import websockets
 import json
 import logging
-import re
+import os
 import sys
+from collections import OrderedDict
+from typing import Any, Optional
+
+# Use orjson (C-accelerated) for the per-frame parse if it's installed;
+# fall back to the stdlib json module otherwise.
+try:
+    import orjson
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        # Decode to str so websockets sends a text frame, as the server expects
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    orjson = None
+    _loads = json.loads
+    _dumps = json.dumps
+
+# msgspec (if installed) can decode a frame straight into a typed Struct,
+# skipping dict construction and key hashing for the dominant 'phrase'
+# frames. Optional, like orjson; the dict-based path is kept as fallback.
+try:
+    import msgspec
+
+    class PhraseMsg(msgspec.Struct):
+        """Typed view of a 'phrase' frame. Unknown fields are ignored;
+        other message types are re-decoded as plain dicts below."""
+        type: str
+        translatedLanguageCode: Optional[str] = None
+        phraseld: Any = None
+        translatedText: Optional[str] = None
+        isFinal: bool = False
+        speakerld: Any = None
+        speakerTag: Any = None
+        name: Optional[str] = None
+
+    _phrase_decoder = msgspec.json.Decoder(PhraseMsg)
+    _any_decoder = msgspec.json.Decoder() # Untyped, for status/end/error/etc.
+except ImportError:
+    msgspec = None
+    PhraseMsg = None
 
 # --- Configuration ---
 WSS_ENDPOINT = "wss://endpoint.wordly.ai/attend"
 CONNECTION_CODE = "9005"
 ATTRIBUTION_LINE = "<Captioning by Wordly.ai>"
 
+# How many finalized phrase IDs to remember for stale-update rejection.
+# Only *recently* finalized phrases can still receive late updates, so a
+# bounded window keeps memory flat over multi-hour sessions.
+FINALIZED_PHRASE_CAP = 4096
+
+# Message types we handle (or deliberately ignore); anything else gets
+# logged as unhandled. frozenset gives O(1) membership in the hot loop.
+_KNOWN_MESSAGE_TYPES = frozenset({"phrase", "status", "end", "users", "speech", "echo", "error"})
+
 # --- Speaker Indication Flags ---
 SHOW_SPEAKER_NAMES = False # Set to True to show "Name: " prefix on speaker change
 SHOW_SPEAKER_CHANGES = True # Set to True to show ">> " prefix on speaker change
@@ -62,42 +112,227 @@ async def listen_to_wordly(pres_code: str, access_key: str, target_lang: str):
     if access_key:
         connect_payload["accessKey"] = access_key
 
+    # Local aliases for values read on every frame: LOAD_FAST beats
+    # LOAD_GLOBAL in the hot loop.
+    loads = _loads
+    if msgspec is not None:
+        phrase_decode = _phrase_decoder.decode
+        any_decode = _any_decoder.decode
+    else:
+        phrase_decode = None
+    log_raw = LOG_RAW_PACKETS
+    show_changes = SHOW_SPEAKER_CHANGES
+    show_names = SHOW_SPEAKER_NAMES
+
     # 2. Define our buffering state variables
     current_phrase_id = None
     current_phrase_text = ""
-    finalized_phrases = set()
+    current_prefix = "" # Speaker prefix of the current phrase (">> ", ">> Name: ", ...)
+
+    # Finalized phrase IDs. When the feed uses monotonically increasing
+    # integer IDs, a rolling bitmask tracks them at ~1 bit per phrase
+    # with no hashing at all; any other ID shape falls back to the
+    # bounded insertion-ordered window. Both are O(1) per check.
+    finalized_mask = 0
+    finalized_base = 0 # Phrase ID that bit 0 of the mask refers to
+    finalized_phrases = OrderedDict()
+
+    def _is_finalized(pid):
+        if type(pid) is int and pid >= 0:
+            if pid < finalized_base:
+                return True # Aged out of the window, so certainly old news
+            return finalized_mask >> (pid - finalized_base) & 1
+        return pid in finalized_phrases
+
+    def _mark_finalized(pid):
+        nonlocal finalized_mask, finalized_base
+        if type(pid) is int and pid >= 0:
+            if pid < finalized_base:
+                return
+            # Slide the window forward *before* setting the bit, so the
+            # shift distance is capped at the window width even if IDs
+            # are huge (timestamp-style) or jump far ahead.
+            excess = pid - finalized_base - FINALIZED_PHRASE_CAP
+            if excess > 0:
+                finalized_mask >>= excess
+                finalized_base += excess
+            finalized_mask |= 1 << (pid - finalized_base)
+        else:
+            finalized_phrases[pid] = None
+            if len(finalized_phrases) > FINALIZED_PHRASE_CAP:
+                finalized_phrases.popitem(last=False) # Evict the oldest entry
 
     # 3. Speaker Tracking State
     last_speaker_id = None
-    last_speaker_tag = None 
+    last_speaker_tag = None
+
+    # 4. Decoupled stdout renderer. Captions go straight to the binary
+    # buffer: one explicit UTF-8 encode and write per line, skipping
+    # print()'s formatting and the TextIO layer. The writer runs in its
+    # own render task, fed by a bounded queue, so a slow terminal (e.g.
+    # piped through ssh) never back-pressures the WebSocket recv loop
+    # into building a server-side backlog.
+    out = sys.stdout.buffer
+
+    def _write_interim(text):
+        # Overwrite the current line in place
+        out.write(b"\r" + text.encode("utf-8"))
+        out.flush()
+
+    def _write_final(text):
+        # Print the finished line *with* a newline
+        out.write(b"\r" + text.encode("utf-8") + b"\n")
+        out.flush()
+
+    # Display ops are ("interim"|"final", phrase_id, text) tuples.
+    render_queue = asyncio.Queue(maxsize=256)
+
+    async def _render_captions(queue):
+        # Each pass drains everything queued: finals are written in
+        # arrival order, while interim ops collapse to the newest one -
+        # only the latest can be on screen after a \r-overwrite anyway.
+        # Sleeping ~33 ms between passes caps the terminal refresh at
+        # ~30 Hz no matter how fast the server pushes updates.
+        try:
+            while True:
+                op = await queue.get()
+                stop = False
+                latest_interim = None
+                while True:
+                    if op is None: # Shutdown sentinel
+                        stop = True
+                    elif op[0] == "final":
+                        if latest_interim is not None and latest_interim[1] == op[1]:
+                            latest_interim = None # Final supersedes its own interim
+                        _write_final(op[2])
+                    else:
+                        latest_interim = op
+                    try:
+                        op = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                if latest_interim is not None:
+                    _write_interim(latest_interim[2])
+                if stop:
+                    return
+                await asyncio.sleep(0.033)
+        except OSError as e:
+            # stdout is gone (broken pipe, closed fd). Stop rendering;
+            # _enqueue sees the finished task and drops further ops, so
+            # the recv loop keeps running without ever blocking here.
+            logging.error("Caption output failed, rendering stopped: %s", e)
+
+    def _enqueue(op):
+        if render_task.done():
+            return # Renderer died (e.g. broken stdout); nothing to display to
+        try:
+            render_queue.put_nowait(op)
+        except asyncio.QueueFull:
+            # Drop the oldest op to make room - stale interim text is
+            # expendable. An evicted final is still written here: it is
+            # the oldest queued op, so output order is preserved.
+            evicted = render_queue.get_nowait()
+            if evicted[0] == "final":
+                try:
+                    _write_final(evicted[2])
+                except OSError:
+                    pass # The renderer will hit the same error and stop
+            render_queue.put_nowait(op)
+
+    # Pre-computed needles for the cheap pre-parse filter below. In a
+    # multi-language presentation most 'phrase' frames are for other
+    # languages; a raw substring check lets us skip the JSON parse for
+    # those entirely. Status/end/error frames never contain the phrase
+    # marker, so they always fall through to the full parse.
+    phrase_marker = '"type":"phrase"'
+    lang_needle = f'"translatedLanguageCode":"{target_lang}"'
+    phrase_marker_b = phrase_marker.encode("utf-8")
+    lang_needle_b = lang_needle.encode("utf-8")
 
     logging.info(f"Connecting to {WSS_ENDPOINT}...")
 
+    render_task = asyncio.create_task(_render_captions(render_queue))
+
     try:
-        # Establish the WebSocket connection
-        async with websockets.connect(WSS_ENDPOINT) as websocket:
+        # Establish the WebSocket connection. Compression is disabled:
+        # caption frames are tiny JSON blobs, so permessage-deflate costs
+        # a zlib inflate per frame for a negligible bandwidth saving.
+        # Buffer limits are sized for small, frequent frames (64 KiB is
+        # plenty for caption JSON) instead of the generic defaults, and a
+        # 30 s ping keeps NAT/idle timeouts from dropping quiet sessions.
+        # Incoming frames are bounded by max_queue (read_limit only exists
+        # in the legacy client API; the new one rejects it).
+        async with websockets.connect(
+            WSS_ENDPOINT,
+            compression=None,
+            max_size=65536,
+            max_queue=64,
+            write_limit=65536,
+            ping_interval=30,
+            ping_timeout=30,
+        ) as websocket:
             logging.info("Connection established. Sending 'connect' request...")
 
             # Send our 'connect' request
-            await websocket.send(json.dumps(connect_payload))
+            await websocket.send(_dumps(connect_payload))
 
             # --- Handshake and Message Loop ---
+            # Decode pipeline note: websockets UTF-8 decodes text frames
+            # to str exactly once before yielding them, and msgspec/orjson
+            # consume that str directly in C - there is no second decode
+            # or re-encode on the hot path. Every branch below (prefilter,
+            # decoders) also accepts raw bytes unchanged, so nothing
+            # breaks if the server ever switches to binary frames, which
+            # would skip the text-frame decode entirely.
             connection_successful = False
             async for message in websocket:
                 try:
-                    data = json.loads(message)
+                    # Skip parsing phrase frames for other languages. (Disabled
+                    # while raw-packet logging is on, so every packet still
+                    # reaches the logger below.)
+                    if not log_raw:
+                        if isinstance(message, bytes):
+                            if phrase_marker_b in message and lang_needle_b not in message:
+                                continue
+                        elif phrase_marker in message and lang_needle not in message:
+                            continue
+
+                    # Decode: typed struct first (no dict churn) when
+                    # msgspec is available, re-decoding the occasional
+                    # non-phrase frame untyped so its extra fields
+                    # (success, message, ...) aren't lost.
+                    if phrase_decode is not None:
+                        try:
+                            data = phrase_decode(message)
+                        except msgspec.ValidationError:
+                            data = any_decode(message)
+                        else:
+                            if data.type != "phrase":
+                                data = any_decode(message)
+                    else:
+                        data = loads(message)
+                    is_struct = type(data) is PhraseMsg
 
                     # --- NEW: Raw Packet Logger ---
-                    if LOG_RAW_PACKETS:
-                        # Log the full packet data at DEBUG level
-                        logging.debug(f"RAW_PACKET_DATA: {data}")
+                    if log_raw and logging.getLogger().isEnabledFor(logging.DEBUG):
+                        # Log the full packet data at DEBUG level. The %s
+                        # form defers the (expensive) dict repr to the
+                        # handler, and isEnabledFor skips even that when
+                        # DEBUG output is filtered out downstream.
+                        logging.debug("RAW_PACKET_DATA: %s", data)
                     # --- End Logger ---
 
-                    msg_type = data.get("type")
+                    if is_struct:
+                        msg_type = "phrase" # Typed decode only survives for phrase frames
+                    else:
+                        # Bind the bound method once; data.get is looked up
+                        # repeatedly per frame otherwise.
+                        g = data.get
+                        msg_type = g("type")
 
                     # --- Step A: Handle Connection Status ---
                     if msg_type == "status":
-                        if data.get("success", False):
+                        if g("success", False):
                             connection_successful = True
                             logging.info(f"Successfully connected to {pres_code} for language '{target_lang}'.")
 
@@ -106,7 +341,7 @@ async def listen_to_wordly(pres_code: str, access_key: str, target_lang: str):
                             sys.stdout.flush() # Ensure it prints immediately
                         else:
                             # Connection failed
-                            error_msg = data.get("message", "Unknown connection error.")
+                            error_msg = g("message", "Unknown connection error.")
                             logging.error(f"Connection failed: {error_msg}")
                             break # Exit the loop and end the script
 
@@ -118,38 +353,53 @@ async def listen_to_wordly(pres_code: str, access_key: str, target_lang: str):
                     # --- Step C: Handle 'phrase' Messages (The Core Logic) ---
                     elif msg_type == "phrase" and connection_successful:
 
+                        # Pull out the fields we need (attribute access on
+                        # the struct, dict lookups on the fallback path)
+                        if is_struct:
+                            tlc = data.translatedLanguageCode
+                            phrase_id = data.phraseld
+                            text = data.translatedText or ""
+                            is_final = data.isFinal
+                            speaker_id = data.speakerld
+                            speaker_tag = data.speakerTag
+                            speaker_name = data.name
+                        else:
+                            tlc = g("translatedLanguageCode")
+                            phrase_id = g("phraseld")
+                            text = g("translatedText", "")
+                            is_final = g("isFinal", False)
+                            speaker_id = g("speakerld")
+                            speaker_tag = g("speakerTag")
+                            speaker_name = g("name")
+
                         # Only process phrases for our target language
-                        if data.get("translatedLanguageCode") != target_lang:
+                        if tlc != target_lang:
                             continue
 
-                        phrase_id = data.get("phraseld")
-                        text = data.get("translatedText", "")
-                        is_final = data.get("isFinal", False)
-
-                        speaker_id = data.get("speakerld")
-                        speaker_tag = data.get("speakerTag")
-                        speaker_name = data.get("name")
-
                         # Ignore any messages for phrases we've already finalized
-                        if phrase_id in finalized_phrases:
+                        if _is_finalized(phrase_id):
                             continue
 
                         # 1. If this is a NEW phrase
                         if phrase_id != current_phrase_id:
                             # Finalize the *previous* phrase by printing it with a newline
                             if current_phrase_id is not None:
-                                print(current_phrase_text) 
-                                sys.stdout.flush()
-                                finalized_phrases.add(current_phrase_id)
+                                _enqueue(("final", current_phrase_id, current_phrase_text))
+                                _mark_finalized(current_phrase_id)
 
                             # --- Check for Speaker Change ---
                             speaker_changed = (speaker_id != last_speaker_id or speaker_tag != last_speaker_tag)
-                            prefix = ""
                             if speaker_changed:
-                                if SHOW_SPEAKER_CHANGES:
-                                    prefix += ">> "
-                                if SHOW_SPEAKER_NAMES and speaker_name:
-                                    prefix += f"{speaker_name}: "
+                                # Build the prefix in one join instead of a += concat chain
+                                parts = []
+                                if show_changes:
+                                    parts.append(">> ")
+                                if show_names and speaker_name:
+                                    parts.append(speaker_name)
+                                    parts.append(": ")
+                                prefix = "".join(parts)
+                            else:
+                                prefix = ""
 
                             # Update speaker memory *after* the check
                             last_speaker_id = speaker_id
@@ -158,75 +408,108 @@ async def listen_to_wordly(pres_code: str, access_key: str, target_lang: str):
 
                             # Start the new phrase
                             current_phrase_id = phrase_id
+                            current_prefix = prefix # Remember it for interim/final updates
                             current_phrase_text = prefix + text # Apply prefix
-                            # Print the start of the new line.
-                            print(f"\r{current_phrase_text}", end="")
-                            sys.stdout.flush()
+                            # Show the start of the new line.
+                            _enqueue(("interim", phrase_id, current_phrase_text))
 
                         # 2. If this is an UPDATE to the current phrase
                         elif phrase_id == current_phrase_id:
                             # Use the previously determined prefix (don't add >> or Name: mid-phrase)
-                            # Find where the actual text starts (after any prefix)
-                            existing_prefix_len = len(current_phrase_text) - len(re.sub(r"^(>> )?([^:]+: )?", "", current_phrase_text))
-                            existing_prefix = current_phrase_text[:existing_prefix_len]
-
-                            current_phrase_text = existing_prefix + text # Apply prefix + new text
+                            current_phrase_text = current_prefix + text # Apply prefix + new text
                             # Overwrite the current line with the updated text
-                            print(f"\r{current_phrase_text}", end="")
-                            sys.stdout.flush()
+                            _enqueue(("interim", phrase_id, current_phrase_text))
 
                         # 3. If the 'isFinal' flag is set
                         if is_final:
-                            # Find where the actual text starts (after any prefix) - handle case where isFinal comes before interim
-                            existing_prefix_len = len(current_phrase_text) - len(re.sub(r"^(>> )?([^:]+: )?", "", current_phrase_text))
-                            existing_prefix = current_phrase_text[:existing_prefix_len]
-
-                            current_phrase_text = existing_prefix + text # Ensure we have the latest text with prefix
+                            # Use the remembered prefix - handles the case where isFinal
+                            # arrives before any interim update too, since the new-phrase
+                            # branch above always runs first and sets current_prefix.
+                            current_phrase_text = current_prefix + text # Ensure we have the latest text with prefix
 
                             # Print the final text *with* a newline
-                            print(f"\r{current_phrase_text}")
-                            sys.stdout.flush()
+                            _enqueue(("final", phrase_id, current_phrase_text))
 
                             # Add to our "ignore" list
-                            finalized_phrases.add(phrase_id)
+                            _mark_finalized(phrase_id)
 
                             # Reset the buffer, ready for the next new phrase
                             current_phrase_id = None
                             current_phrase_text = ""
+                            current_prefix = ""
                             # Do NOT reset speaker_id/tag here - compare next phrase to this final one
 
                     elif msg_type == "error":
-                        logging.warning(f"Received error from server: {data.get('message')}")
+                        logging.warning("Received error from server: %s", g("message"))
 
-                    elif connection_successful and msg_type not in ["phrase", "status", "end", "users", "speech", "echo"]:
-                        if not LOG_RAW_PACKETS: # Avoid double-logging if raw logging is on
-                            logging.debug(f"Received unhandled message type: {msg_type}")
+                    elif connection_successful and msg_type not in _KNOWN_MESSAGE_TYPES:
+                        if not log_raw: # Avoid double-logging if raw logging is on
+                            logging.debug("Received unhandled message type: %s", msg_type)
 
-                except json.JSONDecodeError:
-                    logging.warning(f"Received non-JSON message: {message}")
+                except ValueError:
+                    # Covers json.JSONDecodeError and orjson.JSONDecodeError
+                    logging.warning("Received non-JSON message: %s", message)
                 except Exception as e:
-                    logging.error(f"Error processing message: {e}\nMessage data: {message}")
+                    logging.error("Error processing message: %s\nMessage data: %s", e, message)
 
     except websockets.exceptions.ConnectionClosedError as e:
         logging.error(f"Connection closed unexpectedly: {e}")
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
     finally:
+        # Let the renderer drain anything still queued, then stop it.
+        # Never block here: if the renderer is already dead the queue
+        # may be full and an awaited put would wedge shutdown forever.
+        if not render_task.done():
+            try:
+                render_queue.put_nowait(None)
+            except asyncio.QueueFull:
+                render_task.cancel()
+        try:
+            await render_task
+        except asyncio.CancelledError:
+            pass
         logging.info("Script finished.")
 
 # --- Main execution ---
 if __name__ == "__main__":
+    # Command-line flags (with env-var defaults) allow running the bridge
+    # unattended - e.g. under systemd, or several sessions in parallel -
+    # while anything left unspecified still falls back to the original
+    # interactive prompts.
+    parser = argparse.ArgumentParser(description="Wordly WSS Caption Bridge (MVP v3)")
+    parser.add_argument("--code", default=os.environ.get("WORDLY_CODE"),
+                        help="Presentation Code, e.g. abcd1234 (env: WORDLY_CODE)")
+    parser.add_argument("--key", default=os.environ.get("WORDLY_KEY"),
+                        help="Access Key, if the presentation has one (env: WORDLY_KEY)")
+    parser.add_argument("--lang", default=os.environ.get("WORDLY_LANG"),
+                        help="Target language code, e.g. en, es (env: WORDLY_LANG)")
+    args = parser.parse_args()
+
     print("--- Wordly WSS Caption Bridge (MVP v3) ---")
 
-    raw_code = input("Enter Presentation Code (e.g., abcd1234): ")
-    access_key = input("Enter Access Key (or press Enter if none): ")
-    target_lang = input("Enter Target Language Code (e.g., en, es): ").lower().strip()
+    raw_code = args.code or input("Enter Presentation Code (e.g., abcd1234): ")
+    if args.key is not None:
+        access_key = args.key
+    elif args.code and args.lang:
+        access_key = "" # Fully scripted invocation; assume no access key
+    else:
+        access_key = input("Enter Access Key (or press Enter if none): ")
+    target_lang = (args.lang or input("Enter Target Language Code (e.g., en, es): ")).lower().strip()
 
     formatted_code = format_presentation_code(raw_code)
 
     if not formatted_code or not target_lang:
         print("Presentation Code and Target Language are required. Exiting.")
     else:
+        # Use uvloop's libuv-backed event loop if it's installed; it is a
+        # drop-in replacement that speeds up the WebSocket recv path.
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
+
         try:
             asyncio.run(listen_to_wordly(formatted_code, access_key.strip(), target_lang))
         except KeyboardInterrupt: